@@ -1,15 +1,22 @@
 # src/crawler.py
 
 import os
-import time
+import re
+import atexit
+import pickle
+import anyio
+import asyncio
 import hashlib
+import tempfile
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
-from typing import List, Dict, Set, Optional
-from PIL import Image
-from io import BytesIO
+from urllib.parse import urljoin
+from lxml import html as lxml_html
+from typing import List, Dict, Set, Optional, Tuple, NewType
+from PIL import Image, UnidentifiedImageError
 
 # 设置日志配置
 logging.basicConfig(
@@ -18,175 +25,416 @@ logging.basicConfig(
 )
 logger = logging.getLogger("CrawlerEngine")
 
+# _sniff 可能返回的所有格式，即保存文件时使用的后缀
+IMAGE_FORMATS = ('jpg', 'png', 'gif', 'webp', 'bmp')
+
+# 允许的图片 URL 后缀
+IMAGE_EXTS = frozenset(('jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif'))
+
+# 单张图片大小上限及流式下载的分块大小
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+CHUNK_SIZE = 65536
+
+# 进程的 umask。NamedTemporaryFile 固定以 0600 创建文件，落盘前需按 umask 恢复为普通文件权限
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# 已转为小写的关键词。由调用方 (如 server) 统一 lower() 一次，crawl 内部不再重复处理
+LoweredKeyword = NewType('LoweredKeyword', str)
+
+def _sniff(content: bytes) -> Optional[str]:
+    """根据文件头魔数判断图片格式，非图片 (如 HTML 错误页、空响应) 返回 None"""
+    if content[:2] == b'\xff\xd8':
+        return 'jpg'
+    if content[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if content[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp'
+    if content[:2] == b'BM':
+        return 'bmp'
+    return None
+
 class GenericImageCrawler:
-    def __init__(self, output_dir: str = "downloads"):
+    def __init__(self, output_dir: str = "downloads", concurrency: int = 16):
         """
         初始化爬虫引擎
         
         Args:
             output_dir: 图片保存的根目录
+            concurrency: 单个页面内同时下载的图片数上限
         """
         self.output_dir = output_dir
+        self.concurrency = concurrency
         self.images_dir = os.path.join(output_dir, "images")
         
         # 伪装成浏览器，防止简单的反爬虫
         self.session = requests.Session()
         self.session.headers.update({
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8"
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+            "Connection": "keep-alive"
         })
+
+        # 该 session 只用于页面请求 (图片走 aiohttp)。页面请求受 server 中 8 个线程的上限约束，
+        # 连接池按此大小保留各站点的长连接；对 5xx 做少量快速重试，
+        # 不遵循服务端的 Retry-After，避免一个 503 长时间占住工作线程
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=8,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504],
+                              respect_retry_after_header=False)
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         
         # 创建目录
         if not os.path.exists(self.images_dir):
             os.makedirs(self.images_dir, exist_ok=True)
             
-        self.visited_urls: Set[str] = set()
+        # 启动时一次性读出图片目录下已有的文件名，之后判断文件是否存在只查内存，不再逐个 stat
+        self._existing: Set[str] = {entry.name for entry in os.scandir(self.images_dir)}
+
+        # 预编译过滤规则，crawl 中每个图片标签只做一次 C 层扫描
+        self._reject_re = re.compile(r'logo|icon', re.I)
+
+        # 已落盘图片的 URL -> 文件路径，跨页面/跨网站去重，省去重复的哈希与 stat
+        self._known: Dict[str, str] = {}
+
+        # 页面条件请求缓存: URL -> (ETag, Last-Modified, [(src, alt), ...])
+        # 页面返回 304 时直接复用上次提取的图片列表，无需重新下载和解析
+        self.page_cache_path = os.path.join(output_dir, ".page_cache")
+        self._page_cache: Dict[str, Tuple[Optional[str], Optional[str], List[Tuple[str, str]]]] = \
+            self._load_state(self.page_cache_path) or {}
+
+        atexit.register(self.save_state)
+
+    def _load_state(self, path: str):
+        """从磁盘加载持久化状态，不存在或损坏时返回 None"""
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception as e:
+                logger.warning(f"状态文件加载失败，将重新创建 {path}: {e}")
+        return None
+
+    def save_state(self):
+        """将页面缓存写回磁盘 (进程退出时自动调用)"""
+        try:
+            with open(self.page_cache_path, 'wb') as f:
+                pickle.dump(self._page_cache, f)
+        except Exception as e:
+            logger.error(f"状态文件保存失败 {self.page_cache_path}: {e}")
 
     def is_valid_image_url(self, url: str) -> bool:
-        """检查URL后缀是否为图片格式"""
-        valid_exts = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif'}
-        path = urlparse(url).path
-        ext = os.path.splitext(path)[1].lower()
-        # 有些图片的URL没有后缀，先暂时允许，下载时再校验
-        if not ext: 
-            return True 
-        return ext in valid_exts
-
-    def fetch_page(self, url: str) -> Optional[BeautifulSoup]:
-        """请求网页并返回解析后的 Soup 对象"""
+        """检查URL后缀是否为图片格式 (纯字符串操作，不调用 urlparse)"""
+        # 跳过 scheme://host，主机名里的点不算后缀
+        start = url.find('//')
+        start = 0 if start < 0 else start + 2
+        # 路径在 ? # ; 处结束 (query / fragment / params)
+        end = len(url)
+        for sep in '?#;':
+            i = url.find(sep, start, end)
+            if i >= 0:
+                end = i
+        slash = url.rfind('/', start, end)
+        dot = url.rfind('.', slash + 1, end) if slash >= 0 else -1
+        # 有些图片的URL没有后缀 (包括没有路径、以点开头的文件名)，先暂时允许，下载时再校验
+        if dot <= slash + 1:
+            return True
+        return url[dot + 1:end].lower() in IMAGE_EXTS
+
+    def _extract_images(self, resp: requests.Response) -> List[Tuple[str, str]]:
+        """用 lxml 解析页面，返回所有带地址的图片的 (src, alt)"""
+        # 直接交给 lxml 解码原始字节；仅在响应头声明了 charset 时才指定编码，
+        # 否则让 lxml 根据页面 <meta> 自行判断
+        content_type = resp.headers.get('Content-Type', '').lower()
+        encoding = resp.encoding if 'charset' in content_type else None
+        parser = lxml_html.HTMLParser(encoding=encoding) if encoding else None
+        tree = lxml_html.document_fromstring(resp.content, parser=parser)
+
+        images = []
+        # XPath 在 C 层完成遍历，元素的 .get 直接读取属性
+        for img in tree.xpath('//img'):
+            # 兼容常见的懒加载属性
+            src = img.get('src') or img.get('data-src') or img.get('data-original')
+            if src:
+                images.append((src, img.get('alt', '').strip()))
+        return images
+
+    def fetch_images(self, url: str) -> Optional[List[Tuple[str, str]]]:
+        """请求网页并返回其中图片的 (src, alt) 列表；页面未变化 (304) 时直接使用缓存"""
+        # 只有 HTML 页面要求 gzip 压缩，图片请求单独使用 identity
+        headers = {"Accept-Encoding": "gzip"}
+        cached = self._page_cache.get(url)
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
         try:
-            resp = self.session.get(url, timeout=10)
+            resp = self.session.get(url, headers=headers, timeout=10)
+            if resp.status_code == 304 and cached:
+                logger.info(f"页面未变化，使用缓存: {url}")
+                return cached[2]
             if resp.status_code == 200:
-                return BeautifulSoup(resp.content, 'html.parser') # 如果安装了lxml，改为 'lxml' 解析更快
+                images = self._extract_images(resp)
+                etag = resp.headers.get('ETag')
+                last_modified = resp.headers.get('Last-Modified')
+                if etag or last_modified:
+                    self._page_cache[url] = (etag, last_modified, images)
+                else:
+                    # 页面不再提供校验信息，丢弃旧缓存，避免一直带着过期的条件头
+                    self._page_cache.pop(url, None)
+                return images
             else:
                 logger.warning(f"页面请求失败 [{resp.status_code}]: {url}")
         except Exception as e:
             logger.error(f"无法访问页面 {url}: {e}")
         return None
 
-    def download_image(self, img_url: str, referer: str) -> Optional[Dict]:
+    def _build_stem(self, img_url: str) -> str:
+        """根据 URL 生成唯一哈希文件名 (不含后缀，后缀由下载到的实际格式决定)"""
+        # 哈希仅用于区分文件名，无需加密强度，blake2b 更快
+        img_hash = hashlib.blake2b(img_url.encode(), digest_size=6).hexdigest()
+        return f"img_{img_hash}"
+
+    def _cached_result(self, img_url: str) -> Optional[Dict]:
+        """本进程内已处理过的 URL，直接返回已有文件信息"""
+        filepath = self._known.get(img_url)
+        if filepath is None:
+            return None
+        return {
+            "status": "exists",
+            "path": filepath,
+            "url": img_url,
+            "filename": os.path.basename(filepath)
+        }
+
+    def _remember(self, img_url: str, filepath: str):
+        """记录已落盘的图片"""
+        self._known[img_url] = filepath
+        self._existing.add(os.path.basename(filepath))
+
+    def _find_existing(self, stem: str) -> Optional[str]:
+        """在已有文件名集合中查找同一 URL 保存过的图片，返回其路径"""
+        for fmt in IMAGE_FORMATS:
+            filename = f"{stem}.{fmt}"
+            if filename in self._existing:
+                return os.path.join(self.images_dir, filename)
+        return None
+
+    def _open_temp(self):
+        """在图片目录下创建临时文件，写完校验通过后再原子替换到最终路径"""
+        return tempfile.NamedTemporaryFile(dir=self.images_dir, suffix=".part", delete=False)
+
+    def _discard_temp(self, tmp_path: str):
+        """删除未通过校验的临时文件"""
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def _finalize_image(self, tmp_path: str, head: bytes, size: int, img_url: str, referer: str, stem: str) -> Optional[Dict]:
+        """校验已写入临时文件的图片，通过后移动到最终路径"""
+        saved = False
+        try:
+            if size < 1024: # 忽略小于 1KB 的图
+                return None
+            if size > MAX_IMAGE_BYTES: # 超出大小上限，下载已中途放弃
+                return None
+            # 先用文件头魔数快速排除非图片内容 (如 HTML 错误页)，无需进入 Pillow
+            fmt = _sniff(head)
+            if fmt is None:
+                return None
+            # 后缀以实际格式为准，而不是从 URL 猜测
+            filename = f"{stem}.{fmt}"
+            filepath = os.path.join(self.images_dir, filename)
+
+            # Image.open 是惰性的，只解析文件头即可拿到宽高，不做完整解码/校验
+            try:
+                with Image.open(tmp_path) as image:
+                    width, height = image.size
+            except UnidentifiedImageError:
+                logger.debug(f"无法识别的图片格式: {img_url}")
+                return None
+
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, filepath)
+            saved = True
+        finally:
+            # 未能落盘的临时文件直接删除，不必先 stat 判断是否存在
+            if not saved:
+                self._discard_temp(tmp_path)
+        self._remember(img_url, filepath)
+
+        logger.info(f"下载成功: {filename}")
+        return {
+            "status": "downloaded",
+            "path": filepath,
+            "url": img_url,
+            "referer": referer,
+            "resolution": f"{width}x{height}",
+            "filename": filename
+        }
+
+    async def _download_image_async(self, session: aiohttp.ClientSession, img_url: str, referer: str,
+                                    limiter: Optional[anyio.CapacityLimiter] = None) -> Optional[Dict]:
         """
-        下载并保存图片
+        下载并保存图片 (crawl_async 并发调用；同步场景见 download_image)
         
         Returns:
             Dict: 包含图片路径、元数据的字典；失败则返回 None
         """
         try:
-            # 1. 根据 URL 生成唯一哈希文件名 (防止重复下载)
-            img_hash = hashlib.md5(img_url.encode()).hexdigest()[:12]
-            
-            # 尝试推断后缀，默认为 .jpg
-            path_obj = urlparse(img_url)
-            ext = os.path.splitext(path_obj.path)[1].lower()
-            if not ext or len(ext) > 5: 
-                ext = ".jpg"
-                
-            filename = f"img_{img_hash}{ext}"
-            filepath = os.path.join(self.images_dir, filename)
+            # 1. 本次运行已处理过的 URL 直接返回
+            cached = self._cached_result(img_url)
+            if cached:
+                return cached
+
+            # 2. 根据 URL 生成唯一哈希文件名 (防止重复下载)
+            stem = self._build_stem(img_url)
 
-            # 2. 如果文件已存在，跳过下载
-            if os.path.exists(filepath):
-                return {
-                    "status": "exists", 
-                    "path": filepath, 
-                    "url": img_url,
-                    "filename": filename
-                }
+            # 3. 如果文件已存在，跳过下载
+            existing = self._find_existing(stem)
+            if existing:
+                self._remember(img_url, existing)
+                return self._cached_result(img_url)
 
-            # 3. 发起请求下载
+            # 4. 发起请求下载
             # 添加 Referer 头，有些网站防盗链需要
-            headers = {"Referer": referer}
-            r = self.session.get(img_url, headers=headers, stream=True, timeout=10)
-            
-            if r.status_code == 200:
-                # 4. 读取内存并校验是否为有效图片
-                content = r.content
-                if len(content) < 1024: # 忽略小于 1KB 的图
+            # 图片本身已是压缩格式，不再要求 gzip
+            headers = {"Referer": referer, "Accept-Encoding": "identity"}
+            async with session.get(img_url, headers=headers) as r:
+                if r.status != 200 or (r.content_length or 0) > MAX_IMAGE_BYTES:
                     return None
-                    
-                image = Image.open(BytesIO(content))
-                image.verify() # 校验文件完整性
-                
-                # 5. 写入磁盘
-                with open(filepath, 'wb') as f:
-                    f.write(content)
-                
-                logger.info(f"下载成功: {filename}")
-                return {
-                    "status": "downloaded",
-                    "path": filepath,
-                    "url": img_url,
-                    "referer": referer,
-                    "resolution": f"{image.width}x{image.height}",
-                    "filename": filename
-                }
+
+                # 5. 分块边下载边写入临时文件，超出大小上限立即中止
+                # 创建临时文件放到线程里；逐块 tmp.write 仍在事件循环上执行，
+                # 每次只是把 64KB 写入页缓存，相比等待网络的时间可以忽略
+                tmp = await anyio.to_thread.run_sync(self._open_temp, limiter=limiter)
+                with tmp:
+                    head, size = b'', 0
+                    try:
+                        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                            if len(head) < 16:
+                                head += chunk[:16 - len(head)]
+                            size += len(chunk)
+                            if size > MAX_IMAGE_BYTES:
+                                break
+                            tmp.write(chunk)
+                    except BaseException:
+                        tmp.close()
+                        self._discard_temp(tmp.name)
+                        raise
+
+            # 6. 校验是否为有效图片并移动到最终路径
+            # Pillow 读文件头、os.replace 等同步文件操作放到线程里，不占用事件循环
+            return await anyio.to_thread.run_sync(
+                self._finalize_image, tmp.name, head, size, img_url, referer, stem, limiter=limiter
+            )
         except Exception as e:
             # 静默失败，不要打断整个爬虫
             logger.debug(f"图片下载/校验失败 {img_url}: {e}")
         return None
 
-    def crawl(self, start_url: str, max_images: int = 5, keyword_filter: str = None) -> List[Dict]:
+    def download_image(self, img_url: str, referer: str) -> Optional[Dict]:
+        """_download_image_async 的同步包装，供非异步环境下载单张图片"""
+        async def run() -> Optional[Dict]:
+            async with self._open_session() as session:
+                return await self._download_image_async(session, img_url, referer)
+        return asyncio.run(run())
+
+    def _open_session(self) -> aiohttp.ClientSession:
+        """创建下载图片用的 aiohttp 会话，沿用 requests session 的请求头"""
+        connector = aiohttp.TCPConnector(limit_per_host=4, limit=32)
+        timeout = aiohttp.ClientTimeout(total=10)
+        return aiohttp.ClientSession(headers=dict(self.session.headers), connector=connector, timeout=timeout)
+
+    async def crawl_async(self, start_url: str, max_images: int = 5, keyword_filter: Optional[LoweredKeyword] = None,
+                          limiter: Optional[anyio.CapacityLimiter] = None) -> List[Dict]:
         """
-        核心爬取逻辑
+        核心爬取逻辑 (异步并发下载)
         
         Args:
             start_url: 目标网页 URL
             max_images: 本次任务最大下载数量
-            keyword_filter: (可选) 关键词过滤，匹配 URL 或 alt 文本
+            keyword_filter: (可选) 关键词过滤，匹配 URL 或 alt 文本；须为已转小写的 LoweredKeyword
+            limiter: (可选) 页面请求、文件校验等阻塞操作共用的线程数上限；默认使用 anyio 的全局线程池上限
             
         Returns:
             List[Dict]: 成功下载的图片列表
         """
-        results = []
         logger.info(f"开始爬取页面: {start_url}")
         
-        soup = self.fetch_page(start_url)
-        if not soup:
+        # 页面请求仍走 requests，放到线程里避免阻塞事件循环
+        images = await anyio.to_thread.run_sync(self.fetch_images, start_url, limiter=limiter)
+        if not images:
             return []
+        logger.info(f"页面发现 {len(images)} 个图片标签")
 
-        # 提取所有图片标签
-        img_tags = soup.find_all('img')
-        logger.info(f"页面发现 {len(img_tags)} 个图片标签")
-
-        count = 0
-        for img in img_tags:
-            if count >= max_images:
-                break
-
-            # 兼容常见的懒加载属性
-            raw_src = img.get('src') or img.get('data-src') or img.get('data-original')
-            if not raw_src:
-                continue
-
-            # 处理相对路径
-            full_url = urljoin(start_url, raw_src)
-            alt_text = img.get('alt', '').strip()
+        # 预处理：一次性取出所有图片的 URL / alt 及其小写形式，过滤循环中不再逐个 lower()
+        # 处理相对路径
+        urls = [urljoin(start_url, src) for src, _ in images]
+        alts = [alt for _, alt in images]
+        lowered_urls = [u.lower() for u in urls]
+        lowered_alts = [a.lower() for a in alts] if keyword_filter else alts
 
+        # 先收集所有候选 (url, alt)，再统一并发下载
+        candidates = []
+        for i, full_url in enumerate(urls):
             # --- 过滤逻辑 ---
-            
-            # 1. 关键词过滤
-            if keyword_filter:
-                kw = keyword_filter.lower()
-                # 检查 URL 或 alt 文本是否包含关键词
-                if (kw not in full_url.lower()) and (kw not in alt_text.lower()):
-                    continue
-            
+            # 1. 关键词过滤：URL 或 alt 文本需包含关键词
             # 2. 格式过滤
-            if not self.is_valid_image_url(full_url):
-                continue
-            
             # 3. 排除一些明显的图标/Logo干扰 (简单启发式)
-            if 'logo' in full_url.lower() or 'icon' in full_url.lower():
+            if (keyword_filter and keyword_filter not in lowered_urls[i] and keyword_filter not in lowered_alts[i]) \
+                    or not self.is_valid_image_url(lowered_urls[i]) \
+                    or self._reject_re.search(lowered_urls[i]):
                 continue
 
-            # --- 执行下载 ---
-            meta = self.download_image(full_url, referer=start_url)
-            
+            candidates.append((full_url, alts[i]))
+
+        # --- 执行下载 ---
+        # 用信号量限制并发数，代替原先逐张下载后的礼貌性延时
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # 下载前先占名额 (reserved = 成功 + 进行中)，失败再归还给后面的候选，
+        # 保证落盘数量不超过 max_images；名额满时后续候选等待，直到凑够数量或有名额归还
+        quota = asyncio.Condition()
+        reserved = downloaded = 0
+
+        async def worker(session: aiohttp.ClientSession, img_url: str, alt_text: str) -> Optional[Dict]:
+            nonlocal reserved, downloaded
+            async with quota:
+                await quota.wait_for(lambda: reserved < max_images or downloaded >= max_images)
+                if downloaded >= max_images:
+                    return None
+                reserved += 1
+
+            meta = None
+            try:
+                async with semaphore:
+                    meta = await self._download_image_async(session, img_url, referer=start_url, limiter=limiter)
+            finally:
+                async with quota:
+                    if meta:
+                        downloaded += 1
+                    else:
+                        reserved -= 1
+                    quota.notify_all()
+
             if meta:
                 meta['alt_text'] = alt_text
-                results.append(meta)
-                count += 1
-                # 礼貌性延时，防止对目标服务器造成压力
-                time.sleep(0.3)
+            return meta
+
+        async with self._open_session() as session:
+            metas = await asyncio.gather(*[worker(session, url, alt) for url, alt in candidates])
+
+        return [meta for meta in metas if meta]
 
-        return results
\ No newline at end of file
+    def crawl(self, start_url: str, max_images: int = 5, keyword_filter: Optional[LoweredKeyword] = None) -> List[Dict]:
+        """crawl_async 的同步包装，供非异步环境调用"""
+        return asyncio.run(self.crawl_async(start_url, max_images=max_images, keyword_filter=keyword_filter))
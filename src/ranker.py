@@ -1,55 +1,93 @@
 # src/ranker.py
+import heapq
+import functools
 import tldextract
+import numpy as np
+from urllib.parse import urlparse
 from duckduckgo_search import DDGS
 from typing import List, Dict
 
+# 使用内置的公共后缀快照，避免首次调用时联网下载后缀列表
+_extractor = tldextract.TLDExtract(suffix_list_urls=(), fallback_to_snapshot=True)
+
+@functools.lru_cache(maxsize=4096)
+def _extract_netloc(netloc: str):
+    return _extractor(netloc)
+
+def _extract(url: str):
+    """按域名缓存 tldextract 结果，同一网站的多个结果只解析一次"""
+    return _extract_netloc(urlparse(url).netloc)
+
+# 特征向量第 0 列为黑名单标记，命中即一票否决，固定为 BLOCKED_SCORE，不参与加权
+BLOCKED_SCORE = -1000
+
+# 其余特征的打分权重，与 UniversalRanker.extract_features 第 1 列起的顺序一一对应:
+# [基础分, .edu]
+FEATURE_WEIGHTS = np.array([50, 20], dtype=np.float32)
+
 class UniversalRanker:
     def __init__(self):
         # 通用版：通常 .org, .net, .com 都是中性的
         # 如果你特别讨厌社交媒体，可以保留黑名单
-        self.BLOCK_DOMAINS = {
+        self.BLOCK_DOMAINS = frozenset({
             'pinterest', 'facebook', 'twitter', 'instagram', 'tiktok'
-        }
+        })
         
         # 通用版不需要特定的加分词，或者你可以根据需要动态传入
         # 这里留空，完全依赖搜索引擎的排名
         self.TRUSTED_KEYWORDS = [] 
 
-    def calculate_score(self, result: Dict) -> int:
-        score = 50 # 基础分
+    def extract_features(self, result: Dict) -> np.ndarray:
+        """将单条搜索结果转为特征向量: [黑名单标记, 基础分, .edu]"""
         url = result.get('href', '')
-        
-        extracted = tldextract.extract(url)
-        domain = extracted.domain.lower()
-        
-        # 黑名单一票否决
-        if domain in self.BLOCK_DOMAINS:
-            return -1000
+        extracted = _extract(url)
+        return np.array([
+            self.is_blocked_fast(url),                          # 黑名单一票否决
+            1.0,                                                # 基础分
+            extracted.suffix == 'edu',                          # 比如：如果是 .edu 还是加点分
+        ], dtype=np.float32)
 
+    def score_batch(self, features: np.ndarray) -> np.ndarray:
+        """(N, F) 特征矩阵 -> (N,) 分数向量：黑名单行固定为 BLOCKED_SCORE，其余按权重加权求和"""
+        return np.where(features[:, 0] > 0, BLOCKED_SCORE, features[:, 1:] @ FEATURE_WEIGHTS)
+
+    def calculate_score(self, result: Dict) -> int:
         # 通用逻辑：我们假设排在搜索结果前面的就是好的，不需要太多额外干预
-        # 你可以在这里加自己的逻辑，比如：如果是 .edu 还是加点分
-        if extracted.suffix == 'edu':
-            score += 20
-            
-        return score
+        # 你可以在 extract_features / FEATURE_WEIGHTS 里加自己的特征
+        return int(self.score_batch(self.extract_features(result)[None, :])[0])
+
+    def is_blocked_fast(self, url: str) -> bool:
+        """黑名单判断：先用子串匹配快速放行绝大多数结果，命中时再用 tldextract 确认注册域名"""
+        netloc = urlparse(url).netloc.lower()
+        return any(bad in netloc for bad in self.BLOCK_DOMAINS) \
+            and _extract(url).domain.lower() in self.BLOCK_DOMAINS
 
     def search_and_rank(self, query: str, max_results: int = 10) -> List[Dict]:
         # --- 修改点：直接用用户的 query，不要强制加 "pathology" ---
         print(f"🔍 通用搜索: {query} ...")
         
-        results = []
         try:
             with DDGS() as ddgs:
-                # 搜索图片相关的内容
-                raw_results = list(ddgs.text(query, max_results=max_results))
-                
-                for r in raw_results:
-                    score = self.calculate_score(r)
-                    if score > 0:
-                        r['score'] = score
-                        results.append(r)
+                # 搜索图片相关的内容；多取一些以抵消被黑名单排除的结果。
+                # 边迭代边用同一个黑名单判断提前丢弃，省去这些结果的特征提取与打分
+                candidates = [
+                    r for r in ddgs.text(query, max_results=max_results * 2)
+                    if not self.is_blocked_fast(r.get('href', ''))
+                ]
         except Exception as e:
             print(f"搜索出错: {e}")
             return []
 
-        return sorted(results, key=lambda x: x['score'], reverse=True)
\ No newline at end of file
+        if not candidates:
+            return []
+
+        # 批量打分后只保留前 max_results 个，nlargest 在分数相同时保持搜索引擎原有顺序
+        scores = self.score_batch(np.stack([self.extract_features(r) for r in candidates]))
+        top = heapq.nlargest(max_results, zip(scores.tolist(), candidates), key=lambda t: t[0])
+
+        results = []
+        for score, r in top:
+            if score > 0:
+                r['score'] = int(score)
+                results.append(r)
+        return results
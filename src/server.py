@@ -1,5 +1,7 @@
 # src/server.py
 import os
+import anyio
+import asyncio
 import uvicorn
 from starlette.applications import Starlette
 from starlette.routing import Route
@@ -8,7 +10,7 @@ from mcp.server import Server
 from mcp.types import Tool, TextContent, ImageContent, EmbeddedResource
 
 # 引入之前的逻辑模块
-from .crawler import GenericImageCrawler
+from .crawler import GenericImageCrawler, LoweredKeyword
 from .ranker import UniversalRanker
 
 # 1. 初始化 MCP Server 实例
@@ -18,6 +20,9 @@ app_server = Server("universal-crawler-sse")
 crawler = GenericImageCrawler(output_dir="./downloads")
 ranker = UniversalRanker()
 
+# 搜索、页面请求、图片校验等阻塞调用共用的线程数上限，所有网站的爬取共享这 8 个线程
+limiter = anyio.CapacityLimiter(8)
+
 # 2. 注册工具 (Tool Registration)
 @app_server.list_tools()
 async def handle_list_tools() -> list[Tool]:
@@ -56,8 +61,8 @@ async def handle_call_tool(name: str, arguments: dict | None) -> list[TextConten
         max_sites = arguments.get("max_sites", 3)
         count = arguments.get("count_per_site", 5)
 
-        # 调用 Ranker 进行搜索
-        ranked_sites = ranker.search_and_rank(query, max_results=10)
+        # 调用 Ranker 进行搜索 (同步网络请求，放到线程池里执行，避免阻塞 SSE 事件循环)
+        ranked_sites = await anyio.to_thread.run_sync(ranker.search_and_rank, query, 10, limiter=limiter)
         
         if not ranked_sites:
             return [TextContent(type="text", text="未找到相关网站。")]
@@ -65,16 +70,22 @@ async def handle_call_tool(name: str, arguments: dict | None) -> list[TextConten
         report = [f"🔍 搜索关键词: {query}\n"]
         total_downloaded = 0
 
-        # 遍历网站爬取
-        for i, site in enumerate(ranked_sites[:max_sites]):
-            url = site['href']
+        # 各网站之间互不依赖，并发爬取
+        sites = ranked_sites[:max_sites]
+        # 关键词只在这里 lower() 一次，所有网站的 crawl 共用
+        tokens = query.split()
+        keyword = LoweredKeyword(tokens[0].lower()) if tokens else None
+        results_per_site = await asyncio.gather(
+            *[crawler.crawl_async(site['href'], max_images=count, keyword_filter=keyword, limiter=limiter) for site in sites],
+            return_exceptions=True
+        )
+
+        for i, (site, results) in enumerate(zip(sites, results_per_site)):
             report.append(f"--- 来源 {i+1}: {site['title']} ---")
-            
-            try:
-                # 调用 Crawler
-                # 注意：crawler.crawl 是同步代码，但在 async 函数里调用没问题，
-                # 如果并发量大建议用 asyncio.to_thread 包装，这里简单处理直接调用
-                results = crawler.crawl(url, max_images=count, keyword_filter=query.split()[0])
+
+            if isinstance(results, Exception):
+                report.append(f"❌ 错误: {str(results)}")
+            else:
                 num = len(results)
                 total_downloaded += num
                 
@@ -83,8 +94,6 @@ async def handle_call_tool(name: str, arguments: dict | None) -> list[TextConten
                     report.append(f"✅ 下载 {num} 张 (样例: {', '.join(names)}...)")
                 else:
                     report.append("⚠️ 未抓取到有效图片")
-            except Exception as e:
-                report.append(f"❌ 错误: {str(e)}")
             report.append("")
 
         report.append(f"🎉 任务结束，共保存 {total_downloaded} 张图片至 {crawler.images_dir}")